@@ -0,0 +1,44 @@
+# Generated by Django 4.2.9 on 2026-10-14 10:00
+
+from django.db import migrations
+
+INDEX_NAME = "auth_user_last_login_isoweekday_idx"
+
+
+def forwards_func(apps, schema_editor):
+    """
+    Index the ISO weekday of ``User.last_login``.
+
+    ``sync_active_users_remote_repositories_shard`` filters users by
+    ``ExtractIsoWeekDay("last_login")`` and a ``last_login`` range. The
+    expression has to match the SQL generated by Django for PostgreSQL
+    (``USE_TZ=True`` and ``TIME_ZONE="UTC"``) to be used by the planner.
+    """
+    if schema_editor.connection.vendor != "postgresql":
+        return
+
+    schema_editor.execute(
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {INDEX_NAME} ON auth_user "
+        "((EXTRACT(ISODOW FROM last_login AT TIME ZONE 'UTC')), last_login);"
+    )
+
+
+def backwards_func(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+
+    schema_editor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME};")
+
+
+class Migration(migrations.Migration):
+    # ``CREATE INDEX CONCURRENTLY`` can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("core", "0014_optout_email_build_image_deprecation"),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards_func, backwards_func, atomic=False),
+    ]
@@ -144,6 +144,26 @@ class AdminPermissionBase:
                 Q(teams__organization=obj) | Q(owner_organizations=obj),
             ).distinct()
 
+    @classmethod
+    def member_ids(cls, obj):
+        """
+        Return the ids of the users returned by ``members``, without duplicates.
+
+        For an organization, it reads ``obj.owners`` and the members of
+        ``obj.teams``, so it doesn't perform any query when they are prefetched,
+        e.g. with ``prefetch_related("owners", "teams__members")``.
+        """
+        from readthedocs.organizations.models import Organization
+
+        if isinstance(obj, Organization):
+            users = [*obj.owners.all()]
+            users.extend(
+                member for team in obj.teams.all() for member in team.members.all()
+            )
+        else:
+            users = cls.members(obj)
+        return list(dict.fromkeys(user.pk for user in users))
+
     @classmethod
     def is_admin(cls, user, obj):
         # This explicitly uses "user in project.users.all" so that
@@ -44,6 +44,65 @@ class NotificationQuerySet(models.QuerySet):
 
         return super().create(*args, attached_to=attached_to, **kwargs)
 
+    def add_bulk(self, notifications):
+        """
+        Create many notifications without duplicating them.
+
+        It behaves like calling ``.add()`` for each element of
+        ``notifications`` (a list of dictionaries with the arguments for
+        ``.add()``), but it uses a fixed number of queries instead of two
+        queries per notification.
+        """
+        now = timezone.now()
+
+        # Keep only the last notification for the same object and message
+        pending = {}
+        for arguments in notifications:
+            arguments = dict(arguments)
+            attached_to = arguments.pop("attached_to")
+            content_type = ContentType.objects.get_for_model(attached_to)
+            key = (content_type.pk, attached_to.id, arguments.get("message_id"))
+            pending[key] = (attached_to, arguments)
+
+        if not pending:
+            return []
+
+        existing = {}
+        queryset = self.filter(
+            attached_to_content_type_id__in={key[0] for key in pending},
+            attached_to_id__in={key[1] for key in pending},
+            message_id__in={key[2] for key in pending},
+            # Update only ``READ`` and ``UNREAD`` notifications because we want
+            # to keep track of ``DISMISSED`` and ``CANCELLED`` ones.
+            state__in=(UNREAD, READ),
+        ).order_by("pk")
+        for notification in queryset:
+            key = (
+                notification.attached_to_content_type_id,
+                notification.attached_to_id,
+                notification.message_id,
+            )
+            existing.setdefault(key, notification)
+
+        to_create = []
+        to_update = []
+        updated_fields = {"modified", "state"}
+        for key, (attached_to, arguments) in pending.items():
+            notification = existing.get(key)
+            if notification:
+                for field, value in arguments.items():
+                    setattr(notification, field, value)
+                notification.modified = now
+                notification.state = UNREAD
+                updated_fields.update(arguments)
+                to_update.append(notification)
+            else:
+                to_create.append(self.model(attached_to=attached_to, **arguments))
+
+        if to_update:
+            self.bulk_update(to_update, fields=updated_fields, batch_size=500)
+        return to_update + self.bulk_create(to_create, batch_size=500)
+
     def cancel(self, message_id, attached_to):
         """
         Cancel an on-going notification because the underlying state has changed.
@@ -78,6 +78,67 @@ class TestNotificationQuerySet:
             == 2
         )
 
+    def test_add_bulk(self, django_assert_num_queries):
+        user = fixture.get(User)
+        another_user = fixture.get(User)
+
+        old_notification = Notification.objects.add(
+            attached_to=user,
+            message_id=MESSAGE_EMAIL_VALIDATION_PENDING,
+        )
+        old_notification.state = READ
+        old_notification.save()
+
+        dismissed_notification = Notification.objects.add(
+            attached_to=another_user,
+            message_id=MESSAGE_EMAIL_VALIDATION_PENDING,
+        )
+        dismissed_notification.state = DISMISSED
+        dismissed_notification.save()
+
+        # Select existing notifications, update them and insert the new ones
+        with django_assert_num_queries(3):
+            Notification.objects.add_bulk(
+                [
+                    {
+                        "attached_to": user,
+                        "message_id": MESSAGE_EMAIL_VALIDATION_PENDING,
+                        "format_values": {"value": "updated"},
+                    },
+                    {
+                        "attached_to": user,
+                        "message_id": "user:another:notification",
+                    },
+                    {
+                        "attached_to": another_user,
+                        "message_id": MESSAGE_EMAIL_VALIDATION_PENDING,
+                    },
+                ]
+            )
+
+        # Existing notification is not duplicated, but timestamp and state is updated
+        assert (
+            Notification.objects.filter(
+                attached_to_content_type=ContentType.objects.get_for_model(User),
+                attached_to_id=user.id,
+            ).count()
+            == 2
+        )
+        new_notification = Notification.objects.get(pk=old_notification.pk)
+        assert old_notification.modified < new_notification.modified
+        assert new_notification.state == UNREAD
+        assert new_notification.format_values == {"value": "updated"}
+
+        # Dismissed notifications are kept and a new one is created
+        assert list(
+            Notification.objects.filter(
+                attached_to_content_type=ContentType.objects.get_for_model(User),
+                attached_to_id=another_user.id,
+            )
+            .order_by("pk")
+            .values_list("state", flat=True)
+        ) == [DISMISSED, UNREAD]
+
     def test_cancel(self):
         user = fixture.get(User)
 
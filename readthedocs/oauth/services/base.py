@@ -3,7 +3,6 @@
 from datetime import datetime
 
 import structlog
-from allauth.socialaccount.models import SocialAccount
 from allauth.socialaccount.providers import registry
 from django.conf import settings
 from django.urls import reverse
@@ -55,14 +54,14 @@ class Service:
     @classmethod
     def for_user(cls, user):
         """Return list of instances if user has an account for the provider."""
-        try:
-            accounts = SocialAccount.objects.filter(
-                user=user,
-                provider=cls.adapter.provider_id,
-            )
-            return [cls(user=user, account=account) for account in accounts]
-        except SocialAccount.DoesNotExist:
-            return []
+        # Filter the accounts in Python instead of using
+        # ``SocialAccount.objects.filter()`` to take advantage of
+        # ``prefetch_related("socialaccount_set")`` when the caller uses it.
+        return [
+            cls(user=user, account=account)
+            for account in user.socialaccount_set.all()
+            if account.provider == cls.adapter.provider_id
+        ]
 
     def get_adapter(self):
         return self.adapter
@@ -88,7 +87,14 @@ class Service:
         attributes. If there is an ``expires_at``, treat the session as an auto
         renewing token. Some providers expire tokens after as little as 2 hours.
         """
-        token = self.account.socialtoken_set.first()
+        # Use ``.all()`` to take advantage of
+        # ``prefetch_related("socialaccount_set__socialtoken_set__app")``.
+        # Prefetched tokens aren't ordered, pick the first one by ``pk``.
+        token = min(
+            self.account.socialtoken_set.all(),
+            key=lambda token: token.pk,
+            default=None,
+        )
         if token is None:
             return None
 
@@ -1,13 +1,23 @@
 """Tasks for OAuth services."""
 
 import datetime
+import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager, nullcontext
+from functools import lru_cache
 
 import structlog
 from allauth.socialaccount.providers import registry as allauth_registry
+from celery import group
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import connections
+from django.db.models import F, Prefetch
 from django.db.models.functions import ExtractIsoWeekDay
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from readthedocs.core.permissions import AdminPermission
 from readthedocs.core.utils.tasks import PublicTask, user_id_matches_or_superuser
@@ -18,7 +28,7 @@ from readthedocs.oauth.notifications import (
     MESSAGE_OAUTH_WEBHOOK_NO_PERMISSIONS,
 )
 from readthedocs.oauth.services.base import SyncServiceError
-from readthedocs.oauth.utils import SERVICE_MAP
+from readthedocs.oauth.utils import SERVICE_MAP, provider_slot
 from readthedocs.organizations.models import Organization
 from readthedocs.projects.models import Project
 from readthedocs.sso.models import SSOIntegration
@@ -28,33 +38,280 @@ from .services import registry
 
 log = structlog.get_logger(__name__)
 
+# We have experienced timeout problems on users having a lot of
+# repositories to sync. This is usually due to users belonging to big
+# organizations (e.g. conda-forge).
+SYNC_REMOTE_REPOSITORIES_TIME_LIMIT = 900
+
+SYNC_ACTIVE_USERS_SHARD_TIME_LIMIT = 60 * 30  # 30m
+
+
+# Compiled URL patterns of the registered services, in the registry order
+_SERVICE_URL_PATTERNS = [
+    (service_cls.url_pattern, service_cls)
+    for service_cls in registry
+    if service_cls.url_pattern is not None
+]
+
+
+# Service classes of the registry by allauth provider id, in the registry order
+_PROVIDER_SERVICES = {
+    service_cls.adapter.provider_id: service_cls for service_cls in registry
+}
+
+
+@lru_cache(maxsize=4096)
+def _get_service_for_repository_url(repo):
+    """
+    Return the service class of the repository URL ``repo``.
+
+    This is the same check done by ``Service.is_project_service``, cached by
+    URL so we don't run all the patterns each time a project is imported.
+    """
+    for url_pattern, service_cls in _SERVICE_URL_PATTERNS:
+        if url_pattern.search(repo) is not None:
+            return service_cls
+    return None
+
+
+@lru_cache(maxsize=64)
+def _get_provider(provider_id):
+    """
+    Return the allauth provider for ``provider_id``.
+
+    ``allauth_registry.by_id`` instantiates a new provider on each call,
+    so we cache the instance for each provider in the process.
+    """
+    return allauth_registry.by_id(provider_id)
+
+
+def _get_connected_provider_ids(user):
+    """
+    Return the ids of the providers with a service connected by ``user``.
+
+    It reads ``user.socialaccount_set.all()``, so it doesn't perform any
+    query when the social accounts are prefetched.
+    """
+    connected = {account.provider for account in user.socialaccount_set.all()}
+    return [
+        provider_id for provider_id in _PROVIDER_SERVICES if provider_id in connected
+    ]
+
+
+def _sync_services(services):
+    """
+    Sync all the ``services`` of the same provider, one after the other.
+
+    :returns: whether any of the services failed to sync.
+    """
+    failed = False
+    for service in services:
+        try:
+            service.sync()
+        except SyncServiceError:
+            failed = True
+    return failed
+
+
+def _sync_services_in_thread(service_cls, user, log_context):
+    """
+    Sync the services of ``service_cls`` connected by ``user`` from a new thread.
+
+    The structlog context is local to each thread, so the context of the
+    calling thread is bound again from ``log_context``. The services are
+    created in this thread to keep the context they bind on initialization.
+    The database connections opened by the thread are closed at the end.
+    """
+    log.bind(**log_context)
+    try:
+        return _sync_services(service_cls.for_user(user))
+    finally:
+        connections.close_all()
+
+
+@contextmanager
+def _provider_slots(provider_ids, expire):
+    """
+    Reserve a ``provider_slot`` for each of the ``provider_ids``.
+
+    Yields ``True`` if all the slots were reserved. The reserved slots are
+    released when exiting the context.
+
+    :param expire: seconds after which the slots are released anyway, it
+     should be the hard time limit of the task holding them.
+    """
+    with ExitStack() as stack:
+        yield all(
+            stack.enter_context(
+                provider_slot(
+                    provider_id,
+                    max_workers=settings.RTD_OAUTH_SYNC_MAX_CONCURRENT_PER_PROVIDER,
+                    expire=expire,
+                )
+            )
+            for provider_id in provider_ids
+        )
+
+
+def _get_retry_countdown(attempt):
+    """
+    Return the countdown to retry a sync that couldn't reserve its provider slots.
+
+    The delay doubles on each attempt, up to ``RTD_OAUTH_SYNC_MAX_RETRY_DELAY``,
+    and half of it is random, so the delayed syncs don't retry all at once.
+
+    :param attempt: number of times the sync was already delayed.
+    """
+    delay = min(
+        settings.RTD_OAUTH_SYNC_RETRY_DELAY * 2 ** min(attempt, 10),
+        settings.RTD_OAUTH_SYNC_MAX_RETRY_DELAY,
+    )
+    return delay // 2 + random.randint(0, delay // 2)
+
+
+def _sync_remote_repositories(user, in_threads=True, throttle=True):
+    """
+    Sync ``RemoteRepository`` of all the services connected by ``user``.
+
+    This is the body of ``sync_remote_repositories``, it can be called
+    directly with an already fetched user to avoid the task overhead.
+    See ``_sync_providers`` for ``in_threads``.
+
+    The number of workers hitting each provider's API at the same time is
+    limited. If any of the providers connected by the user is busy, nothing
+    is synced.
+
+    :param throttle: reserve a slot of each provider connected by the user.
+     Callers already holding the slots pass ``False``.
+    :returns: names of the providers that failed to sync, or ``None`` if the
+     sync was skipped because a provider is busy.
+    :rtype: set
+    """
+    provider_ids = _get_connected_provider_ids(user)
+    if throttle:
+        slots = _provider_slots(
+            provider_ids, expire=SYNC_REMOTE_REPOSITORIES_TIME_LIMIT
+        )
+    else:
+        slots = nullcontext(True)
+    with slots as slots_acquired:
+        if not slots_acquired:
+            return None
+        return _sync_providers(user, provider_ids, in_threads=in_threads)
+
+
+def _sync_providers(user, provider_ids, in_threads=True):
+    """
+    Sync the services of ``provider_ids`` connected by ``user``.
+
+    Syncing a service is mostly waiting for the provider's API, so each
+    provider is synced in a different thread. Accounts from the same provider
+    are synced in the same thread, since they may share the same
+    ``RemoteRepository`` and ``RemoteOrganization`` objects.
+
+    :param in_threads: sync the providers one after the other in the current
+     thread when ``False``. Each new thread opens its own database connection.
+    :returns: names of the providers that failed to sync.
+    :rtype: set
+    """
+    # ``Service.provider_name`` looks up the provider on each access
+    services = {
+        _get_provider(provider_id).name: _PROVIDER_SERVICES[provider_id]
+        for provider_id in provider_ids
+    }
+
+    if not in_threads or len(services) <= 1:
+        # Avoid the overhead of a new thread, and its database connection,
+        # when there is only one provider to sync.
+        return {
+            provider_name
+            for provider_name, service_cls in services.items()
+            if _sync_services(service_cls.for_user(user))
+        }
+
+    log_context = structlog.get_context(log.bind()).copy()
+    failed_services = set()
+    executor = ThreadPoolExecutor(max_workers=len(services))
+    try:
+        futures = {
+            executor.submit(
+                _sync_services_in_thread, service_cls, user, log_context
+            ): provider_name
+            for provider_name, service_cls in services.items()
+        }
+        for future in as_completed(futures):
+            if future.result():
+                failed_services.add(futures[future])
+    except BaseException:
+        # Celery raises ``SoftTimeLimitExceeded`` in the main thread only.
+        # Wait for the provider threads that are still syncing, so they don't
+        # outlive the task and keep hitting the provider's API after its slot
+        # is released. The wait is bounded by the hard time limit, which kills
+        # the worker process along with its threads.
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown()
+    return failed_services
+
+
+def _delay_sync_remote_repositories(user, attempt):
+    """
+    Trigger ``sync_remote_repositories`` for ``user`` again, after a delay.
+
+    It's used when a provider connected by the user is busy. The sync is
+    retried until the slots are reserved, it's never given up.
+
+    :param attempt: number of times the sync was already delayed.
+    """
+    countdown = _get_retry_countdown(attempt)
+    log.info(
+        "Concurrency limit reached for provider, delaying sync.",
+        user_username=user.username,
+        attempt=attempt,
+        countdown=countdown,
+    )
+    sync_remote_repositories.apply_async(
+        args=[user.pk],
+        kwargs={"attempt": attempt + 1},
+        countdown=countdown,
+    )
+
 
 @PublicTask.permission_check(user_id_matches_or_superuser)
 @app.task(
     queue="web",
     base=PublicTask,
-    # We have experienced timeout problems on users having a lot of
-    # repositories to sync. This is usually due to users belonging to big
-    # organizations (e.g. conda-forge).
-    time_limit=900,
+    time_limit=SYNC_REMOTE_REPOSITORIES_TIME_LIMIT,
     soft_time_limit=600,
 )
-def sync_remote_repositories(user_id):
-    user = User.objects.filter(pk=user_id).first()
+def sync_remote_repositories(user_id, attempt=0):
+    # Services only need the user's ``pk`` and ``username``,
+    # besides the social accounts, tokens and apps.
+    user = (
+        User.objects.filter(pk=user_id)
+        .only("pk", "username")
+        .prefetch_related("socialaccount_set__socialtoken_set__app")
+        .first()
+    )
     if not user:
         return
 
-    failed_services = set()
-    for service_cls in registry:
-        for service in service_cls.for_user(user):
-            try:
-                service.sync()
-            except SyncServiceError:
-                failed_services.add(service.provider_name)
+    # Tasks executed eagerly run in the process of the caller, there are no
+    # workers to throttle. Delaying them would run them again right away.
+    throttle = not sync_remote_repositories.request.is_eager
+    failed_services = _sync_remote_repositories(user, throttle=throttle)
+    if failed_services is None:
+        # A provider is busy, delay the sync instead of waiting for a slot in
+        # this worker. The provider slots are already released at this point.
+        # NOTE: we can't use ``self.retry`` here because ``PublicTask``
+        # catches all the exceptions raised by the task.
+        _delay_sync_remote_repositories(user, attempt)
+        return
+
     if failed_services:
         raise SyncServiceError(
             SyncServiceError.INVALID_OR_REVOKED_ACCESS_TOKEN.format(
-                provider=", ".join(failed_services)
+                provider=", ".join(sorted(failed_services))
             )
         )
 
@@ -64,7 +321,8 @@ def sync_remote_repositories_organizations(organization_slugs=None):
     """
     Re-sync users member of organizations.
 
-    It will trigger one `sync_remote_repositories` task per user.
+    It will trigger one `sync_remote_repositories` task per user, even if the
+    user is member of more than one organization.
 
     :param organization_slugs: list containg organization's slugs to sync. If
     not passed, all organizations with ALLAUTH SSO enabled will be synced
@@ -73,44 +331,57 @@ def sync_remote_repositories_organizations(organization_slugs=None):
     """
     if organization_slugs:
         query = Organization.objects.filter(slug__in=organization_slugs)
+    else:
+        query = Organization.objects.filter(
+            ssointegration__provider=SSOIntegration.PROVIDER_ALLAUTH
+        )
+
+    organizations = list(
+        query.prefetch_related(
+            Prefetch("owners", queryset=User.objects.only("pk")),
+            Prefetch("teams__members", queryset=User.objects.only("pk")),
+        )
+    )
+    if organization_slugs:
         log.info(
             "Triggering SSO re-sync for organizations.",
             organization_slugs=organization_slugs,
-            count=query.count(),
+            count=len(organizations),
         )
     else:
-        organization_ids = SSOIntegration.objects.filter(
-            provider=SSOIntegration.PROVIDER_ALLAUTH
-        ).values_list("organization", flat=True)
-        query = Organization.objects.filter(id__in=organization_ids)
         log.info(
             "Triggering SSO re-sync for all organizations.",
-            count=query.count(),
+            count=len(organizations),
         )
 
-    n_task = -1
-    for organization in query:
-        members = AdminPermission.members(organization)
+    # Keep the users in order, without duplicates
+    user_ids = {}
+    for organization in organizations:
+        # Read from the prefetched owners and team members
+        # to avoid one query per organization.
+        member_ids = AdminPermission.member_ids(organization)
         log.info(
             "Triggering SSO re-sync for organization.",
             organization_slug=organization.slug,
-            count=members.count(),
-        )
-        for user in members:
-            n_task += 1
-            sync_remote_repositories.apply_async(
-                args=[user.pk],
-                # delay the task by 0, 5, 10, 15, ... seconds
-                countdown=n_task * 5,
-            )
+            count=len(member_ids),
+        )
+        user_ids.update(dict.fromkeys(member_ids))
 
+    log.info("Triggering SSO re-sync for users.", count=len(user_ids))
 
-@app.task(
-    queue="web",
-    time_limit=60 * 60 * 3,  # 3h
-    soft_time_limit=(60 * 60 * 3) - 5 * 60,  # 2h 55m
-)
-def sync_active_users_remote_repositories():
+    # Publish all the tasks at once, each user is still synced in its own
+    # task, with its own time limits.
+    group(
+        sync_remote_repositories.si(user_id).set(
+            # delay the task by 0, 5, 10, 15, ... seconds, up to one hour
+            countdown=min(n_task * 5, 3600),
+        )
+        for n_task, user_id in enumerate(user_ids)
+    ).apply_async()
+
+
+@app.task(queue="web")
+def sync_active_users_remote_repositories(n_shards=20):
     """
     Sync ``RemoteRepository`` for active users.
 
@@ -120,41 +391,156 @@ def sync_active_users_remote_repositories():
     last login of the user with today's weekday. If they match, the re-sync is
     triggered. This logic guarantees us the re-sync to be done once a week per user.
 
-    Note this is a long running task syncronizhing all the users in the same Celery process,
-    and it will require a pretty high ``time_limit`` and ``soft_time_limit``.
+    The users are split in ``n_shards`` groups (by primary key) and one
+    ``sync_active_users_remote_repositories_shard`` task is triggered per
+    group, so the synchronization runs concurrently in different Celery processes.
+
+    :param n_shards: number of tasks to split the active users into.
     """
-    today_weekday = timezone.now().isoweekday()
-    three_months_ago = timezone.now() - datetime.timedelta(days=90)
-    users = User.objects.annotate(weekday=ExtractIsoWeekDay("last_login")).filter(
-        last_login__gt=three_months_ago,
-        socialaccount__isnull=False,
-        weekday=today_weekday,
+    now = timezone.now()
+    today_weekday = now.isoweekday()
+    three_months_ago = now - datetime.timedelta(days=90)
+    log.info(
+        "Triggering re-sync of RemoteRepository for active users.",
+        n_shards=n_shards,
     )
+    for shard in range(n_shards):
+        sync_active_users_remote_repositories_shard.apply_async(
+            args=[shard, n_shards],
+            kwargs={
+                "weekday": today_weekday,
+                "last_login_after": three_months_ago.isoformat(),
+            },
+            # delay the task by 0, 2, 4, 6, ... seconds
+            countdown=shard * 2,
+        )
 
-    users_count = users.count()
-    log.bind(total_users=users_count)
-    log.info("Triggering re-sync of RemoteRepository for active users.")
 
-    for i, user in enumerate(users):
-        log.bind(
-            user_username=user.username,
-            progress=f"{i}/{users_count}",
+@app.task(
+    queue="web",
+    bind=True,
+    time_limit=SYNC_ACTIVE_USERS_SHARD_TIME_LIMIT,
+    soft_time_limit=SYNC_ACTIVE_USERS_SHARD_TIME_LIMIT - 60,  # 29m
+)
+def sync_active_users_remote_repositories_shard(
+    self, shard, n_shards, weekday=None, last_login_after=None
+):
+    """
+    Sync ``RemoteRepository`` for the active users of one shard.
+
+    Only active users whose ``pk % n_shards`` is ``shard`` are synced.
+
+    Note this is a long running task syncronizhing all the users of the shard
+    in the same Celery process, and it will require a pretty high
+    ``time_limit`` and ``soft_time_limit``.
+
+    The shard holds a slot of each provider while it runs, instead of
+    reserving them for each user. If any provider is busy, the whole shard
+    is retried later.
+
+    :param shard: index of the shard to sync (from ``0`` to ``n_shards - 1``).
+    :param n_shards: total number of shards the active users are split into.
+    :param weekday: ISO weekday of the last login of the users to sync.
+     Defaults to today's weekday.
+    :param last_login_after: ISO 8601 datetime, only users that logged in
+     after it are synced. Defaults to 90 days ago.
+    """
+    if weekday is None:
+        weekday = timezone.now().isoweekday()
+    if last_login_after is None:
+        three_months_ago = timezone.now() - datetime.timedelta(days=90)
+    else:
+        three_months_ago = parse_datetime(last_login_after)
+    users = (
+        User.objects.only("pk", "username", "last_login")
+        .annotate(
+            # NOTE: there is a PostgreSQL index on this expression and
+            # ``last_login``, see ``core`` migration 0015.
+            weekday=ExtractIsoWeekDay("last_login"),
+            shard=F("pk") % n_shards,
+        )
+        .filter(
+            last_login__gt=three_months_ago,
+            socialaccount__isnull=False,
+            weekday=weekday,
+            shard=shard,
         )
+        # The join with ``socialaccount`` returns the user once per account.
+        .distinct()
+        # Services read the social accounts, tokens and apps from the user object.
+        .prefetch_related("socialaccount_set__socialtoken_set__app")
+    )
 
-        # Log an update every 50 users
+    users_count = users.count()
+    log.bind(
+        shard=shard,
+        n_shards=n_shards,
+        total_users=users_count,
+    )
+    # Tasks executed eagerly run in the process of the caller, there are no
+    # workers to throttle. Retrying them would run them again right away.
+    if self.request.is_eager:
+        slots = nullcontext(True)
+    else:
+        slots = _provider_slots(
+            _PROVIDER_SERVICES, expire=SYNC_ACTIVE_USERS_SHARD_TIME_LIMIT
+        )
+    with slots as slots_acquired:
+        if slots_acquired:
+            log.info("Triggering re-sync of RemoteRepository for active users.")
+            _sync_active_users(users, users_count)
+
+    if not slots_acquired:
+        # Retry once the slots are released, so this task doesn't hold any.
+        countdown = _get_retry_countdown(self.request.retries)
+        log.info(
+            "Concurrency limit reached for provider, delaying shard.",
+            countdown=countdown,
+        )
+        raise self.retry(countdown=countdown, max_retries=None)
+
+
+def _sync_active_users(users, users_count):
+    """Sync ``RemoteRepository`` for ``users``, already holding the provider slots."""
+    # Process the users in batches to keep the memory usage flat.
+    for i, user in enumerate(users.iterator(chunk_size=500)):
+        # Log an update every 50 users. Pass the values to the log call
+        # instead of binding them to the context on each iteration.
         if i % 50 == 0:
-            log.info("Progress on re-syncing RemoteRepository for active users.")
+            log.info(
+                "Progress on re-syncing RemoteRepository for active users.",
+                user_username=user.username,
+                progress=f"{i}/{users_count}",
+            )
 
         try:
-            # NOTE: sync all the users/repositories in the same Celery process.
-            # Do not trigger a new task per user.
-            sync_remote_repositories(user.pk)
+            # NOTE: sync all the users/repositories of the shard in the same
+            # Celery process. Do not trigger a new task per user. Pass the
+            # user object directly to use the prefetched social accounts.
+            # Shards already run concurrently, don't open new threads (and
+            # database connections) for each user.
+            _sync_remote_repositories(user, in_threads=False, throttle=False)
+        except SoftTimeLimitExceeded:
+            # Stop the shard, instead of starting the sync of the next user
+            # right before the task is killed by the hard time limit.
+            log.warning(
+                "Soft time limit reached re-syncing RemoteRepository.",
+                user_username=user.username,
+                progress=f"{i}/{users_count}",
+            )
+            raise
         except Exception:
-            log.exception("There was a problem re-syncing RemoteRepository.")
+            log.exception(
+                "There was a problem re-syncing RemoteRepository.",
+                user_username=user.username,
+                progress=f"{i}/{users_count}",
+            )
 
 
 @app.task(queue="web")
-def attach_webhook(project_pk, user_pk, integration=None):
+def attach_webhook(
+    project_pk=None, user_pk=None, *, project=None, user=None, integration=None
+):
     """
     Add post-commit hook on project import.
 
@@ -162,65 +548,69 @@ def attach_webhook(project_pk, user_pk, integration=None):
     all accounts until we set up a webhook. This should remain around for legacy
     connections -- that is, projects that do not have a remote repository them
     and were not set up with a VCS provider.
+
+    When this task is called synchronously, ``project`` and ``user`` can be
+    passed directly to avoid fetching them again.
     """
-    project = Project.objects.filter(pk=project_pk).first()
-    user = User.objects.filter(pk=user_pk).first()
+    if project is None:
+        # GitLab needs the remote repository of the project to set up the webhook.
+        project = (
+            Project.objects.select_related("remote_repository")
+            .filter(pk=project_pk)
+            .first()
+        )
+    if user is None:
+        user = User.objects.filter(pk=user_pk).first()
 
     if not project or not user:
         return False
 
+    # Use the service of the integration type when there is an integration,
+    # otherwise guess it from the repository URL.
     if integration:
         service = SERVICE_MAP.get(integration.integration_type)
-
-        if not service:
-            log.warning("There are no registered services in the application.")
-            Notification.objects.add(
-                message_id=MESSAGE_OAUTH_WEBHOOK_INVALID,
-                attached_to=project,
-                dismissable=True,
-                format_values={
-                    "url_integrations": reverse(
-                        "projects_integrations",
-                        args=[project.slug],
-                    ),
-                },
-            )
-            return None
     else:
-        for service_cls in registry:
-            if service_cls.is_project_service(project):
-                service = service_cls
-                break
-        else:
-            log.warning("There are no registered services in the application.")
-            Notification.objects.add(
-                message_id=MESSAGE_OAUTH_WEBHOOK_INVALID,
-                attached_to=project,
-                dismissable=True,
-                format_values={
-                    "url_integrations": reverse(
-                        "projects_integrations",
-                        args=[project.slug],
-                    ),
-                },
-            )
-            return None
+        service = _get_service_for_repository_url(project.repo)
+
+    if service is None:
+        log.warning("There are no registered services in the application.")
+        Notification.objects.add(
+            message_id=MESSAGE_OAUTH_WEBHOOK_INVALID,
+            attached_to=project,
+            dismissable=True,
+            format_values={
+                "url_integrations": reverse(
+                    "projects_integrations",
+                    args=[project.slug],
+                ),
+            },
+        )
+        return None
+
+    provider = _get_provider(service.adapter.provider_id)
 
-    provider = allauth_registry.by_id(service.adapter.provider_id)
+    # Accounts without an OAuth token can't set up a webhook, skip them
+    # instead of calling the provider with no session.
+    has_valid_account = False
+    for account in service.for_user(user):
+        if account.get_session() is None:
+            continue
 
-    user_accounts = service.for_user(user)
-    for account in user_accounts:
+        has_valid_account = True
         success, __ = account.setup_webhook(project, integration=integration)
         if success:
             # NOTE: do we want to communicate that we connect the webhook here?
             # messages.add_message(request, "Webhook successfully added.")
 
+            # Update only this field, without running ``Project.save``
+            # and its signals, which aren't needed for this change.
+            Project.objects.filter(pk=project.pk).update(has_valid_webhook=True)
             project.has_valid_webhook = True
-            project.save()
             return True
 
-    # No valid account found
-    if user_accounts:
+    # No valid account found. Users with only accounts
+    # without a token need to connect their account again.
+    if has_valid_account:
         Notification.objects.add(
             message_id=MESSAGE_OAUTH_WEBHOOK_NO_PERMISSIONS,
             dismissable=True,
@@ -1,7 +1,11 @@
 """Support code for OAuth, including webhook support."""
 
+import uuid
+from contextlib import contextmanager
+
 import structlog
 from django.contrib import messages
+from django.core.cache import cache
 from django.utils.translation import gettext_lazy as _
 
 from readthedocs.integrations.models import Integration
@@ -16,6 +20,39 @@ SERVICE_MAP = {
 }
 
 
+@contextmanager
+def provider_slot(provider_id, max_workers, expire):
+    """
+    Reserve one of the ``max_workers`` concurrent slots to sync ``provider_id``.
+
+    Each slot is a different key in Django's cache, added with an expiration
+    of ``expire`` seconds. Slots of workers killed before releasing them are
+    recovered after that time, independently of the other slots.
+
+    The slots are only shared by all the Celery workers when a shared cache
+    backend is used (e.g. Redis). ``LocMemCache`` is local to each process.
+
+    Yields ``True`` if a slot was reserved and ``False`` if all the slots are
+    already taken by other workers.
+    """
+    # Identify this holder, so we don't release a slot that expired
+    # and was reserved again by another worker.
+    token = uuid.uuid4().hex
+    for slot in range(max_workers):
+        key = f"oauth-sync-slot-{provider_id}-{slot}"
+        if cache.add(key, token, expire):
+            break
+    else:
+        yield False
+        return
+
+    try:
+        yield True
+    finally:
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
 def update_webhook(project, integration, request=None):
     """Update a specific project integration instead of brute forcing."""
     # FIXME: this method supports ``request=None`` on its definition.
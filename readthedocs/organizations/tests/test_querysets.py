@@ -7,7 +7,8 @@ from django_dynamic_fixture import get
 from djstripe import models as djstripe
 from djstripe.enums import InvoiceStatus, SubscriptionStatus
 
-from readthedocs.organizations.models import Organization
+from readthedocs.core.permissions import AdminPermission
+from readthedocs.organizations.models import Organization, Team, TeamMember
 
 
 @override_settings(
@@ -32,6 +33,32 @@ class TestOrganizationQuerysets(TestCase):
             {org_three}, set(Organization.objects.single_owner(another_user))
         )
 
+    def test_member_ids(self):
+        owner = get(User)
+        member = get(User)
+        another_member = get(User)
+
+        organization = get(Organization, owners=[owner])
+        team = get(Team, organization=organization)
+        another_team = get(Team, organization=organization)
+        get(TeamMember, team=team, member=member)
+        get(TeamMember, team=another_team, member=member)
+        get(TeamMember, team=another_team, member=another_member)
+        # The owner is returned once, even if they are members of a team too.
+        get(TeamMember, team=team, member=owner)
+        get(Organization, owners=[get(User)])
+
+        organization = Organization.objects.prefetch_related(
+            "owners", "teams__members"
+        ).get(pk=organization.pk)
+        with self.assertNumQueries(0):
+            member_ids = AdminPermission.member_ids(organization)
+        self.assertEqual(len(member_ids), 3)
+        self.assertEqual(
+            set(member_ids),
+            set(AdminPermission.members(organization).values_list("pk", flat=True)),
+        )
+
     def test_organizations_with_trial_subscription_plan_ended(self):
         price = get(djstripe.Price, id="trialing")
 
@@ -117,6 +117,7 @@ def finish_inactive_builds():
 
     projects_finished = set()
     builds_finished = []
+    notifications = []
     builds = Build.objects.filter(query)[:50]
     for build in builds:
         if build.project.container_time_limit:
@@ -132,14 +133,18 @@ def finish_inactive_builds():
         build.state = BUILD_STATE_CANCELLED
         build.save()
 
-        Notification.objects.add(
-            message_id=BuildAppError.BUILD_TERMINATED_DUE_INACTIVITY,
-            attached_to=build,
+        notifications.append(
+            {
+                "message_id": BuildAppError.BUILD_TERMINATED_DUE_INACTIVITY,
+                "attached_to": build,
+            }
         )
 
         builds_finished.append(build.pk)
         projects_finished.add(build.project.slug)
 
+    Notification.objects.add_bulk(notifications)
+
     log.info(
         'Builds marked as "Terminated due inactivity".',
         count=len(builds_finished),
@@ -877,9 +877,9 @@ class IntegrationCreate(IntegrationMixin, CreateView):
         self.object = form.save()
         if self.object.has_sync:
             attach_webhook(
-                project_pk=self.get_project().pk,
-                user_pk=self.request.user.pk,
-                integration=self.object
+                project=self.get_project(),
+                user=self.request.user,
+                integration=self.object,
             )
         return HttpResponseRedirect(self.get_success_url())
 
@@ -935,8 +935,8 @@ class IntegrationWebhookSync(IntegrationMixin, GenericView):
             # webhook or a remote repository object, the user should be using
             # the per-integration sync instead.
             attach_webhook(
-                project_pk=self.get_project().pk,
-                user_pk=request.user.pk,
+                project=self.get_project(),
+                user=request.user,
             )
         return HttpResponseRedirect(self.get_success_url())
 
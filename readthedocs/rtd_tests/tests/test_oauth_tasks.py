@@ -1,27 +1,72 @@
-from unittest.mock import patch
+import datetime
+import threading
+import time
+from unittest.mock import call, patch
 
-from allauth.socialaccount.models import SocialAccount
+import structlog
+from allauth.socialaccount.models import SocialAccount, SocialToken
 from allauth.socialaccount.providers.bitbucket_oauth2.views import (
     BitbucketOAuth2Adapter,
 )
 from allauth.socialaccount.providers.github.views import GitHubOAuth2Adapter
 from allauth.socialaccount.providers.gitlab.views import GitLabOAuth2Adapter
+from celery.exceptions import Retry, SoftTimeLimitExceeded
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
 from django_dynamic_fixture import get
 
 from readthedocs.builds.models import Version
+from readthedocs.integrations.models import Integration
+from readthedocs.notifications.models import Notification
+from readthedocs.oauth.notifications import (
+    MESSAGE_OAUTH_WEBHOOK_INVALID,
+    MESSAGE_OAUTH_WEBHOOK_NO_ACCOUNT,
+    MESSAGE_OAUTH_WEBHOOK_NO_PERMISSIONS,
+)
 from readthedocs.oauth.services.base import SyncServiceError
 from readthedocs.oauth.tasks import (
+    attach_webhook,
+    sync_active_users_remote_repositories,
+    sync_active_users_remote_repositories_shard,
     sync_remote_repositories,
     sync_remote_repositories_organizations,
 )
-from readthedocs.organizations.models import Organization, OrganizationOwner
+from readthedocs.oauth.utils import provider_slot
+from readthedocs.organizations.models import (
+    Organization,
+    OrganizationOwner,
+    Team,
+    TeamMember,
+)
 from readthedocs.projects.models import Project
 from readthedocs.sso.models import SSOIntegration
 
 
 class SyncRemoteRepositoriesTests(TestCase):
+    PROVIDER_IDS = (
+        GitHubOAuth2Adapter.provider_id,
+        GitLabOAuth2Adapter.provider_id,
+        BitbucketOAuth2Adapter.provider_id,
+    )
+
+    def _get_slot_keys(self, provider_id):
+        return [
+            f"oauth-sync-slot-{provider_id}-{slot}"
+            for slot in range(settings.RTD_OAUTH_SYNC_MAX_CONCURRENT_PER_PROVIDER)
+        ]
+
+    def _get_reserved_slots(self, provider_id):
+        """Return the number of slots of ``provider_id`` reserved by any worker."""
+        return len(cache.get_many(self._get_slot_keys(provider_id)))
+
+    def _reserve_all_slots(self, provider_id):
+        """Reserve all the slots of ``provider_id``, as other workers would do."""
+        self.addCleanup(cache.clear)
+        cache.set_many(dict.fromkeys(self._get_slot_keys(provider_id), "other"))
+
     def setUp(self):
         self.user = get(User)
         self.project = get(Project, users=[self.user])
@@ -75,14 +120,225 @@ class SyncRemoteRepositoriesTests(TestCase):
         self.assertIn("GitHub", r["error"])
         self.assertIn("Bitbucket", r["error"])
         self.assertNotIn("GitLab", r["error"])
+        # Providers are sorted to always get the same message
+        self.assertIn("Bitbucket, GitHub", r["error"])
         sync_bb.assert_called_once()
         sync_gl.assert_called_once()
         sync_gh.assert_called_once()
 
-    @patch("readthedocs.oauth.tasks.sync_remote_repositories")
-    def test_sync_remote_repository_organizations_slugs(
-        self, mock_sync_remote_repositories
+    @patch("readthedocs.oauth.services.github.GitHubService.sync")
+    @patch("readthedocs.oauth.services.gitlab.GitLabService.sync")
+    @patch("readthedocs.oauth.services.bitbucket.BitbucketService.sync")
+    def test_sync_repository_providers_in_threads(self, sync_bb, sync_gl, sync_gh):
+        # A second GitHub account is synced in the same thread as the first one
+        get(
+            SocialAccount,
+            user=self.user,
+            provider=GitHubOAuth2Adapter.provider_id,
+        )
+        threads = {}
+        for name, sync in (("bb", sync_bb), ("gl", sync_gl), ("gh", sync_gh)):
+            sync.side_effect = lambda name=name: threads.setdefault(name, set()).add(
+                threading.get_ident()
+            )
+
+        sync_remote_repositories(self.user.pk)
+        self.assertEqual(sync_gh.call_count, 2)
+        self.assertEqual(len(threads["gh"]), 1)
+        all_threads = threads["bb"] | threads["gl"] | threads["gh"]
+        self.assertNotIn(threading.get_ident(), all_threads)
+
+    @patch("readthedocs.oauth.services.github.GitHubService.sync", autospec=True)
+    @patch("readthedocs.oauth.services.gitlab.GitLabService.sync", autospec=True)
+    @patch("readthedocs.oauth.services.bitbucket.BitbucketService.sync", autospec=True)
+    def test_sync_repository_providers_in_threads_log_context(
+        self, sync_bb, sync_gl, sync_gh
+    ):
+        log = structlog.get_logger(__name__)
+        log.bind(test_context="value")
+        self.addCleanup(log.try_unbind, "test_context")
+
+        contexts = []
+        for sync in (sync_bb, sync_gl, sync_gh):
+            sync.side_effect = lambda service: contexts.append(
+                (service, structlog.get_context(log.bind()).copy())
+            )
+
+        sync_remote_repositories(self.user.pk)
+        self.assertEqual(len(contexts), 3)
+        for service, context in contexts:
+            self.assertEqual(context["test_context"], "value")
+            self.assertEqual(context["user_username"], self.user.username)
+            self.assertEqual(context["social_provider"], service.provider_id)
+            self.assertEqual(context["social_account_id"], service.account.pk)
+
+    @patch("readthedocs.oauth.tasks.as_completed")
+    @patch("readthedocs.oauth.services.github.GitHubService.sync")
+    @patch("readthedocs.oauth.services.gitlab.GitLabService.sync")
+    @patch("readthedocs.oauth.services.bitbucket.BitbucketService.sync")
+    def test_sync_repository_soft_time_limit(
+        self, sync_bb, sync_gl, sync_gh, as_completed
+    ):
+        # The provider threads are still syncing when the soft time limit
+        # is raised in the main thread.
+        finished = []
+        slots_reserved = []
+
+        def sync_service():
+            time.sleep(0.5)
+            slots_reserved.append(
+                all(
+                    self._get_reserved_slots(provider_id) == 1
+                    for provider_id in self.PROVIDER_IDS
+                )
+            )
+            finished.append(threading.get_ident())
+
+        for sync in (sync_bb, sync_gl, sync_gh):
+            sync.side_effect = sync_service
+        as_completed.side_effect = SoftTimeLimitExceeded
+
+        r = sync_remote_repositories(self.user.pk)
+        self.assertIn("error", r)
+        # The task waits for the threads, holding the slots until they finish
+        self.assertEqual(len(finished), 3)
+        self.assertEqual(slots_reserved, [True, True, True])
+        for provider_id in self.PROVIDER_IDS:
+            self.assertEqual(self._get_reserved_slots(provider_id), 0)
+
+    @patch("readthedocs.oauth.services.github.GitHubService.sync")
+    @patch("readthedocs.oauth.services.gitlab.GitLabService.for_user")
+    @patch("readthedocs.oauth.services.bitbucket.BitbucketService.for_user")
+    def test_sync_repository_only_connected_services(
+        self, for_user_bb, for_user_gl, sync_gh
+    ):
+        user = get(User)
+        get(
+            SocialAccount,
+            user=user,
+            provider=GitHubOAuth2Adapter.provider_id,
+        )
+        # Accounts from providers without a service are ignored
+        get(SocialAccount, user=user, provider="google")
+
+        r = sync_remote_repositories(user.pk)
+        self.assertNotIn("error", r)
+        sync_gh.assert_called_once()
+        for_user_gl.assert_not_called()
+        for_user_bb.assert_not_called()
+
+    @patch("readthedocs.oauth.services.github.GitHubService.sync")
+    @patch("readthedocs.oauth.services.gitlab.GitLabService.sync")
+    @patch("readthedocs.oauth.services.bitbucket.BitbucketService.sync")
+    def test_sync_repository_releases_provider_slots(self, sync_bb, sync_gl, sync_gh):
+        sync_gh.side_effect = SyncServiceError
+        sync_remote_repositories(self.user.pk)
+        for provider_id in self.PROVIDER_IDS:
+            self.assertEqual(self._get_reserved_slots(provider_id), 0)
+
+    @override_settings(RTD_OAUTH_SYNC_MAX_CONCURRENT_PER_PROVIDER=1)
+    @patch.object(sync_remote_repositories, "apply_async")
+    @patch("readthedocs.oauth.services.github.GitHubService.sync")
+    @patch("readthedocs.oauth.services.gitlab.GitLabService.sync")
+    @patch("readthedocs.oauth.services.bitbucket.BitbucketService.sync")
+    def test_sync_repository_provider_concurrency_limit_reached(
+        self, sync_bb, sync_gl, sync_gh, apply_async
+    ):
+        # Other workers are syncing GitLab already
+        self._reserve_all_slots(GitLabOAuth2Adapter.provider_id)
+
+        r = sync_remote_repositories(self.user.pk)
+        self.assertNotIn("error", r)
+        apply_async.assert_called_once()
+        _, kwargs = apply_async.call_args
+        self.assertEqual(kwargs["args"], [self.user.pk])
+        self.assertEqual(kwargs["kwargs"], {"attempt": 1})
+        self.assertTrue(15 <= kwargs["countdown"] <= 30)
+        sync_bb.assert_not_called()
+        sync_gl.assert_not_called()
+        sync_gh.assert_not_called()
+        # The slots reserved by this task are released before delaying the sync
+        self.assertEqual(self._get_reserved_slots(GitHubOAuth2Adapter.provider_id), 0)
+        self.assertEqual(
+            self._get_reserved_slots(BitbucketOAuth2Adapter.provider_id), 0
+        )
+        self.assertEqual(self._get_reserved_slots(GitLabOAuth2Adapter.provider_id), 1)
+
+    @override_settings(
+        RTD_OAUTH_SYNC_MAX_CONCURRENT_PER_PROVIDER=1,
+        RTD_OAUTH_SYNC_MAX_RETRY_DELAY=600,
+    )
+    @patch.object(sync_remote_repositories, "apply_async")
+    def test_sync_repository_provider_concurrency_limit_backoff(self, apply_async):
+        self._reserve_all_slots(GitLabOAuth2Adapter.provider_id)
+
+        # The sync is never given up, the delay grows up to the max delay.
+        for attempt, min_countdown, max_countdown in (
+            (3, 120, 240),
+            (20, 300, 600),
+        ):
+            apply_async.reset_mock()
+            sync_remote_repositories(self.user.pk, attempt=attempt)
+            _, kwargs = apply_async.call_args
+            self.assertEqual(kwargs["kwargs"], {"attempt": attempt + 1})
+            self.assertTrue(min_countdown <= kwargs["countdown"] <= max_countdown)
+
+    @override_settings(RTD_OAUTH_SYNC_MAX_CONCURRENT_PER_PROVIDER=1)
+    @patch.object(sync_remote_repositories, "apply_async")
+    @patch("readthedocs.oauth.services.github.GitHubService.sync")
+    @patch("readthedocs.oauth.services.gitlab.GitLabService.sync")
+    @patch("readthedocs.oauth.services.bitbucket.BitbucketService.sync")
+    def test_sync_repository_eager_ignores_concurrency_limit(
+        self, sync_bb, sync_gl, sync_gh, apply_async
     ):
+        self._reserve_all_slots(GitLabOAuth2Adapter.provider_id)
+
+        sync_remote_repositories.apply(args=[self.user.pk])
+        apply_async.assert_not_called()
+        sync_bb.assert_called_once()
+        sync_gl.assert_called_once()
+        sync_gh.assert_called_once()
+
+    def test_provider_slot(self):
+        self.addCleanup(cache.clear)
+        provider_id = GitHubOAuth2Adapter.provider_id
+        with provider_slot(provider_id, max_workers=2, expire=900) as acquired:
+            self.assertTrue(acquired)
+            with provider_slot(provider_id, max_workers=2, expire=900) as acquired:
+                self.assertTrue(acquired)
+                with provider_slot(provider_id, max_workers=2, expire=900) as acquired:
+                    self.assertFalse(acquired)
+                self.assertEqual(
+                    len(cache.get_many(self._get_slot_keys(provider_id))), 2
+                )
+            # A slot is available again after releasing it
+            with provider_slot(provider_id, max_workers=2, expire=900) as acquired:
+                self.assertTrue(acquired)
+        self.assertEqual(self._get_reserved_slots(provider_id), 0)
+
+    def test_provider_slot_expired(self):
+        self.addCleanup(cache.clear)
+        provider_id = GitHubOAuth2Adapter.provider_id
+        key = f"oauth-sync-slot-{provider_id}-0"
+        with provider_slot(provider_id, max_workers=1, expire=900) as acquired:
+            self.assertTrue(acquired)
+            # The slot expired and another worker reserved it
+            cache.set(key, "other")
+        # The slot of the other worker isn't released
+        self.assertEqual(cache.get(key), "other")
+
+    def _get_grouped_user_ids(self, mock_group):
+        """Return the user ids of the tasks passed to the mocked ``group``."""
+        mock_group.assert_called_once()
+        mock_group().apply_async.assert_called_once_with()
+        signatures = list(mock_group.call_args_list[0].args[0])
+        for n_task, signature in enumerate(signatures):
+            self.assertEqual(signature.task, sync_remote_repositories.name)
+            self.assertEqual(signature.options["countdown"], min(n_task * 5, 3600))
+        return [signature.args[0] for signature in signatures]
+
+    @patch("readthedocs.oauth.tasks.group")
+    def test_sync_remote_repository_organizations_slugs(self, mock_group):
         organization = get(Organization)
         get(
             OrganizationOwner,
@@ -90,15 +346,27 @@ class SyncRemoteRepositoriesTests(TestCase):
             organization=organization,
         )
         sync_remote_repositories_organizations(organization_slugs=[organization.slug])
-        mock_sync_remote_repositories.apply_async.assert_called_once_with(
-            args=[self.user.pk],
-            countdown=0,
-        )
+        self.assertEqual(self._get_grouped_user_ids(mock_group), [self.user.pk])
 
-    @patch("readthedocs.oauth.tasks.sync_remote_repositories")
-    def test_sync_remote_repository_organizations_without_slugs(
-        self, mock_sync_remote_repositories
+    @patch("readthedocs.oauth.services.github.GitHubService.sync")
+    @patch("readthedocs.oauth.services.gitlab.GitLabService.sync")
+    @patch("readthedocs.oauth.services.bitbucket.BitbucketService.sync")
+    def test_sync_remote_repository_organizations_tasks(
+        self, sync_bb, sync_gl, sync_gh
     ):
+        organization = get(Organization)
+        get(
+            OrganizationOwner,
+            owner=self.user,
+            organization=organization,
+        )
+        sync_remote_repositories_organizations(organization_slugs=[organization.slug])
+        sync_bb.assert_called_once()
+        sync_gl.assert_called_once()
+        sync_gh.assert_called_once()
+
+    @patch("readthedocs.oauth.tasks.group")
+    def test_sync_remote_repository_organizations_without_slugs(self, mock_group):
         organization = get(Organization)
         get(
             SSOIntegration,
@@ -112,7 +380,308 @@ class SyncRemoteRepositoriesTests(TestCase):
         )
 
         sync_remote_repositories_organizations()
-        mock_sync_remote_repositories.apply_async.assert_called_once_with(
-            args=[self.user.pk],
-            countdown=0,
+        self.assertEqual(self._get_grouped_user_ids(mock_group), [self.user.pk])
+
+    @patch("readthedocs.oauth.tasks.group")
+    def test_sync_remote_repository_organizations_queries(self, mock_group):
+        users = [self.user]
+        for _ in range(2):
+            organization = get(Organization)
+            get(
+                SSOIntegration,
+                provider=SSOIntegration.PROVIDER_ALLAUTH,
+                organization=organization,
+            )
+            get(
+                OrganizationOwner,
+                owner=self.user,
+                organization=organization,
+            )
+            team = get(Team, organization=organization)
+            for _ in range(2):
+                user = get(User)
+                get(TeamMember, team=team, member=user)
+                users.append(user)
+            # Owners that are team members too, or members of more than one
+            # organization, are only synced once
+            get(TeamMember, team=team, member=self.user)
+
+        # Organizations, owners, teams and team members
+        with self.assertNumQueries(4):
+            sync_remote_repositories_organizations()
+
+        self.assertEqual(
+            sorted(self._get_grouped_user_ids(mock_group)),
+            sorted(user.pk for user in users),
+        )
+
+    @patch("readthedocs.oauth.tasks.sync_active_users_remote_repositories_shard")
+    def test_sync_active_users_remote_repositories(self, mock_shard_task):
+        now = timezone.now()
+        with patch("readthedocs.oauth.tasks.timezone.now", return_value=now):
+            sync_active_users_remote_repositories(n_shards=3)
+        kwargs = {
+            "weekday": now.isoweekday(),
+            "last_login_after": (now - datetime.timedelta(days=90)).isoformat(),
+        }
+        mock_shard_task.apply_async.assert_has_calls(
+            [
+                call(args=[0, 3], kwargs=kwargs, countdown=0),
+                call(args=[1, 3], kwargs=kwargs, countdown=2),
+                call(args=[2, 3], kwargs=kwargs, countdown=4),
+            ]
+        )
+        self.assertEqual(mock_shard_task.apply_async.call_count, 3)
+
+    @patch("readthedocs.oauth.tasks._sync_remote_repositories")
+    def test_sync_active_users_remote_repositories_shard(
+        self, mock_sync_remote_repositories
+    ):
+        last_login = timezone.now() - datetime.timedelta(days=7)
+        users = [self.user, get(User), get(User), get(User)]
+        for user in users:
+            user.last_login = last_login
+            user.save()
+            get(
+                SocialAccount,
+                user=user,
+                provider=GitHubOAuth2Adapter.provider_id,
+            )
+
+        # Inactive users are never synced
+        inactive_user = get(
+            User,
+            last_login=timezone.now() - datetime.timedelta(days=91),
+        )
+        get(
+            SocialAccount,
+            user=inactive_user,
+            provider=GitHubOAuth2Adapter.provider_id,
+        )
+
+        n_shards = 2
+        synced_users = []
+        for shard in range(n_shards):
+            mock_sync_remote_repositories.reset_mock()
+            sync_active_users_remote_repositories_shard(shard, n_shards)
+            shard_users = [
+                args[0].pk for args, _ in mock_sync_remote_repositories.call_args_list
+            ]
+            for user_id in shard_users:
+                self.assertEqual(user_id % n_shards, shard)
+            synced_users.extend(shard_users)
+
+        # Each user is synced once, even if they have more than one social account.
+        self.assertEqual(sorted(synced_users), sorted(user.pk for user in users))
+
+        # Users that didn't log in after ``last_login_after`` aren't synced
+        mock_sync_remote_repositories.reset_mock()
+        sync_active_users_remote_repositories_shard(
+            0, 1, last_login_after=timezone.now().isoformat()
+        )
+        mock_sync_remote_repositories.assert_not_called()
+
+    @patch("readthedocs.oauth.tasks._sync_remote_repositories")
+    def test_sync_active_users_remote_repositories_shard_soft_time_limit(
+        self, mock_sync_remote_repositories
+    ):
+        last_login = timezone.now() - datetime.timedelta(days=7)
+        for user in (self.user, get(User)):
+            user.last_login = last_login
+            user.save()
+            get(
+                SocialAccount,
+                user=user,
+                provider=GitHubOAuth2Adapter.provider_id,
+            )
+        mock_sync_remote_repositories.side_effect = SoftTimeLimitExceeded
+
+        with self.assertRaises(SoftTimeLimitExceeded):
+            sync_active_users_remote_repositories_shard(0, 1)
+        # The next user isn't synced after the soft time limit
+        mock_sync_remote_repositories.assert_called_once()
+
+    @override_settings(RTD_OAUTH_SYNC_MAX_CONCURRENT_PER_PROVIDER=1)
+    @patch.object(sync_active_users_remote_repositories_shard, "retry")
+    @patch.object(sync_remote_repositories, "apply_async")
+    @patch("readthedocs.oauth.services.github.GitHubService.sync")
+    def test_sync_active_users_remote_repositories_shard_concurrency_limit_reached(
+        self, sync_gh, apply_async, retry
+    ):
+        self.user.last_login = timezone.now() - datetime.timedelta(days=7)
+        self.user.save()
+        self._reserve_all_slots(GitHubOAuth2Adapter.provider_id)
+        retry.return_value = Retry()
+
+        with self.assertRaises(Retry):
+            sync_active_users_remote_repositories_shard(0, 1)
+        sync_gh.assert_not_called()
+        # Users aren't sent to their own task, the whole shard is retried.
+        apply_async.assert_not_called()
+        retry.assert_called_once()
+        _, kwargs = retry.call_args
+        self.assertIsNone(kwargs["max_retries"])
+        self.assertTrue(15 <= kwargs["countdown"] <= 30)
+        for provider_id in self.PROVIDER_IDS[1:]:
+            self.assertEqual(self._get_reserved_slots(provider_id), 0)
+
+    @patch("readthedocs.oauth.services.github.GitHubService.sync", autospec=True)
+    @patch("readthedocs.oauth.services.gitlab.GitLabService.sync", autospec=True)
+    @patch("readthedocs.oauth.services.bitbucket.BitbucketService.sync", autospec=True)
+    def test_sync_active_users_remote_repositories_shard_queries(
+        self, sync_bb, sync_gl, sync_gh
+    ):
+        last_login = timezone.now() - datetime.timedelta(days=7)
+        for user in (self.user, get(User), get(User)):
+            user.last_login = last_login
+            user.save()
+            get(
+                SocialAccount,
+                user=user,
+                provider=GitHubOAuth2Adapter.provider_id,
+            )
+        for account in SocialAccount.objects.all():
+            get(SocialToken, account=account, expires_at=None)
+
+        # Create the OAuth session of each service, as ``sync`` does.
+        threads = set()
+
+        def sync_service(service):
+            threads.add(threading.get_ident())
+            self.assertIsNotNone(service.get_session())
+            # The shard holds a slot of each provider
+            for provider_id in self.PROVIDER_IDS:
+                self.assertEqual(self._get_reserved_slots(provider_id), 1)
+
+        for sync in (sync_bb, sync_gl, sync_gh):
+            sync.side_effect = sync_service
+
+        # Count, users, and the prefetched social accounts, tokens and apps,
+        # independently of the number of users.
+        with self.assertNumQueries(5):
+            sync_active_users_remote_repositories_shard(0, 1)
+
+        self.assertEqual(sync_gh.call_count, 4)
+        sync_gl.assert_called_once()
+        sync_bb.assert_called_once()
+        # Shards don't open a new thread per provider
+        self.assertEqual(threads, {threading.get_ident()})
+
+
+class AttachWebhookTests(TestCase):
+    def setUp(self):
+        self.user = get(User)
+        self.project = get(
+            Project,
+            users=[self.user],
+            repo="https://github.com/readthedocs/readthedocs.org",
+            has_valid_webhook=False,
+        )
+
+    def _get_social_account(self, with_token=True):
+        account = get(
+            SocialAccount,
+            user=self.user,
+            provider=GitHubOAuth2Adapter.provider_id,
+        )
+        if with_token:
+            get(SocialToken, account=account, expires_at=None)
+        return account
+
+    def _notifications(self):
+        return Notification.objects.filter(attached_to_id=self.project.pk)
+
+    @patch("readthedocs.oauth.services.github.GitHubService.setup_webhook")
+    def test_attach_webhook(self, setup_webhook):
+        self._get_social_account()
+        setup_webhook.return_value = (True, None)
+
+        self.assertTrue(attach_webhook(self.project.pk, self.user.pk))
+        setup_webhook.assert_called_once_with(self.project, integration=None)
+        self.project.refresh_from_db()
+        self.assertTrue(self.project.has_valid_webhook)
+        self.assertFalse(self._notifications().exists())
+
+    @patch("readthedocs.oauth.services.github.GitHubService.setup_webhook")
+    def test_attach_webhook_with_objects(self, setup_webhook):
+        self._get_social_account()
+        setup_webhook.return_value = (True, None)
+
+        # The project and user aren't fetched again, only the social accounts
+        # of the user and their tokens are queried before updating the project.
+        with self.assertNumQueries(4):
+            self.assertTrue(attach_webhook(project=self.project, user=self.user))
+        setup_webhook.assert_called_once_with(self.project, integration=None)
+        # The instance passed is updated too
+        self.assertTrue(self.project.has_valid_webhook)
+        self.project.refresh_from_db()
+        self.assertTrue(self.project.has_valid_webhook)
+
+    @patch("readthedocs.oauth.services.github.GitHubService.setup_webhook")
+    def test_attach_webhook_no_permissions(self, setup_webhook):
+        self._get_social_account()
+        setup_webhook.return_value = (False, None)
+
+        self.assertFalse(attach_webhook(self.project.pk, self.user.pk))
+        self.project.refresh_from_db()
+        self.assertFalse(self.project.has_valid_webhook)
+        self.assertEqual(
+            self._notifications().get().message_id,
+            MESSAGE_OAUTH_WEBHOOK_NO_PERMISSIONS,
+        )
+
+    @patch("readthedocs.oauth.services.github.GitHubService.setup_webhook")
+    def test_attach_webhook_skip_accounts_without_token(self, setup_webhook):
+        self._get_social_account(with_token=False)
+        self._get_social_account()
+        setup_webhook.return_value = (False, None)
+
+        self.assertFalse(attach_webhook(self.project.pk, self.user.pk))
+        setup_webhook.assert_called_once_with(self.project, integration=None)
+        self.assertEqual(
+            self._notifications().get().message_id,
+            MESSAGE_OAUTH_WEBHOOK_NO_PERMISSIONS,
+        )
+
+    @patch("readthedocs.oauth.services.github.GitHubService.setup_webhook")
+    def test_attach_webhook_only_accounts_without_token(self, setup_webhook):
+        self._get_social_account(with_token=False)
+
+        self.assertFalse(attach_webhook(self.project.pk, self.user.pk))
+        setup_webhook.assert_not_called()
+        self.assertEqual(
+            self._notifications().get().message_id,
+            MESSAGE_OAUTH_WEBHOOK_NO_ACCOUNT,
+        )
+
+    def test_attach_webhook_no_account(self):
+        self.assertFalse(attach_webhook(self.project.pk, self.user.pk))
+        self.assertEqual(
+            self._notifications().get().message_id,
+            MESSAGE_OAUTH_WEBHOOK_NO_ACCOUNT,
+        )
+
+    def test_attach_webhook_unknown_service(self):
+        self.project.repo = "https://git.example.com/readthedocs/readthedocs.org"
+        self.project.save()
+
+        self.assertIsNone(attach_webhook(self.project.pk, self.user.pk))
+        self.assertEqual(
+            self._notifications().get().message_id,
+            MESSAGE_OAUTH_WEBHOOK_INVALID,
+        )
+
+    def test_attach_webhook_integration_without_service(self):
+        integration = get(
+            Integration,
+            project=self.project,
+            integration_type=Integration.API_WEBHOOK,
+        )
+
+        self.assertIsNone(
+            attach_webhook(self.project.pk, self.user.pk, integration=integration)
+        )
+        self.assertEqual(
+            self._notifications().get().message_id,
+            MESSAGE_OAUTH_WEBHOOK_INVALID,
         )
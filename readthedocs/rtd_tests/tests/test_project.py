@@ -12,6 +12,7 @@ from django_dynamic_fixture import get
 from rest_framework.reverse import reverse
 
 from readthedocs.builds.constants import (
+    BUILD_STATE_CANCELLED,
     BUILD_STATE_CLONING,
     BUILD_STATE_FINISHED,
     BUILD_STATE_TRIGGERED,
@@ -20,6 +21,9 @@ from readthedocs.builds.constants import (
     TAG,
 )
 from readthedocs.builds.models import Build, Version
+from readthedocs.doc_builder.exceptions import BuildAppError
+from readthedocs.notifications.constants import READ, UNREAD
+from readthedocs.notifications.models import Notification
 from readthedocs.oauth.services import GitHubService, GitLabService
 from readthedocs.projects.constants import (
     GITHUB_BRAND,
@@ -606,3 +610,47 @@ class TestFinishInactiveBuildsTask(TestCase):
         self.assertTrue(self.build_3.success)
         self.assertEqual(self.build_3.error, '')
         self.assertEqual(self.build_3.state, BUILD_STATE_TRIGGERED)
+
+    def test_finish_inactive_builds_notifications(self):
+        builds = []
+        for _ in range(3):
+            build = Build.objects.create(
+                project=self.pip,
+                version=self.pip.get_stable_version(),
+                state=BUILD_STATE_TRIGGERED,
+            )
+            build.date = timezone.now() - datetime.timedelta(hours=3)
+            build.save()
+            builds.append(build)
+
+        # An existing notification is marked as unread again, not duplicated
+        Notification.objects.add(
+            message_id=BuildAppError.BUILD_TERMINATED_DUE_INACTIVITY,
+            attached_to=builds[0],
+        )
+        Notification.objects.filter(attached_to_id=builds[0].pk).update(state=READ)
+
+        finish_inactive_builds()
+
+        for build in builds:
+            build.refresh_from_db()
+            self.assertFalse(build.success)
+            self.assertEqual(build.state, BUILD_STATE_CANCELLED)
+
+            notification = Notification.objects.get(
+                attached_to_content_type__model="build",
+                attached_to_id=build.pk,
+            )
+            self.assertEqual(
+                notification.message_id,
+                BuildAppError.BUILD_TERMINATED_DUE_INACTIVITY,
+            )
+            self.assertEqual(notification.state, UNREAD)
+
+        # Builds still within the time limit aren't notified
+        self.assertFalse(
+            Notification.objects.filter(
+                attached_to_content_type__model="build",
+                attached_to_id__in=[self.build_1.pk, self.build_2.pk, self.build_3.pk],
+            ).exists()
+        )
@@ -356,8 +356,8 @@ class TestPrivateViews(TestCase):
         self.assertTrue(integration.exists())
         self.assertEqual(response.status_code, 302)
         attach_webhook.assert_called_once_with(
-            project_pk=self.project.pk,
-            user_pk=self.user.pk,
+            project=self.project,
+            user=self.user,
             integration=integration.first(),
         )
 
@@ -141,6 +141,12 @@ class CommunityBaseSettings(Settings):
     RTD_BUILDS_MAX_RETRIES = 25
     RTD_BUILDS_RETRY_DELAY = 5 * 60  # seconds
     RTD_BUILD_STATUS_API_NAME = 'docs/readthedocs'
+    # Max number of concurrent RemoteRepository syncs per VCS provider.
+    # Each shard of ``sync_active_users_remote_repositories`` (20 by default)
+    # holds a slot of each provider while it runs, keep some for the rest.
+    RTD_OAUTH_SYNC_MAX_CONCURRENT_PER_PROVIDER = 30
+    RTD_OAUTH_SYNC_RETRY_DELAY = 30  # seconds
+    RTD_OAUTH_SYNC_MAX_RETRY_DELAY = 60 * 10  # seconds
     RTD_ANALYTICS_DEFAULT_RETENTION_DAYS = 30 * 3
     RTD_AUDITLOGS_DEFAULT_RETENTION_DAYS = 30 * 3
 